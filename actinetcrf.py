@@ -2,13 +2,15 @@
 # %autoreload 2
 
 import datetime
+import glob
+import hashlib
+import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader, random_split
 import torch.nn.functional as F
-from torchcrf import CRF
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
@@ -16,142 +18,316 @@ from sklearn.metrics import precision_score, recall_score, f1_score
 from scipy.signal import savgol_filter
 
 class SleepDataset(Dataset):
-    def __init__(self, parquet_file, sequence_length, is_test=False):
-        self.data = pd.read_parquet(parquet_file)
+    # Bump when the layout of the cached arrays changes so existing caches are rebuilt
+    cache_version = 2
+
+    def __init__(self, parquet_file, sequence_length, is_test=False, train_mode=False, cache_dir='cache'):
+        if train_mode and is_test:
+            raise ValueError('train_mode needs labels, so it cannot be used with is_test=True')
         self.is_test = is_test
+        self.train_mode = train_mode
         self.sequence_length = sequence_length
-        self.series_ids = self.data['series_id'].unique()
-        self.data_chunks = self.preprocess_data()
-
-    def preprocess_data(self):
-        data_chunks = []
-        for series_id in self.series_ids:
-            series_data = self.data[self.data['series_id'] == series_id]
-            data = series_data[['anglez', 'enmo']].values.astype(np.float32)
-            try:
-                timestamp = pd.to_datetime(series_data['timestamp'], utc=True).view('float').values / 10 ** 9
-            except:
-                breakpoint()
-            step = series_data['step'].values.astype(np.float32)
-
-            # Divide the time series into equal-sized chunks
-            for i in range(0, len(data), self.sequence_length):
-                chunk_data = data[i:i + self.sequence_length, :]
-                chunk_timestamp = timestamp[i:i + self.sequence_length]
-                chunk_step = step[i:i + self.sequence_length]
-
-                if len(chunk_data) == self.sequence_length:  # Only include if the chunk is of sufficient length
-                    if not self.is_test:
-                        label = series_data['label'].values[i:i + self.sequence_length].astype(float)
-                        data_chunks.append({'series_id': series_id, 'step': chunk_step, 'timestamp': chunk_timestamp, 'data': chunk_data, 'label': label})
-                    else:
-                        data_chunks.append({'series_id': series_id, 'step': chunk_step, 'timestamp': chunk_timestamp, 'data': chunk_data})
-
-        return data_chunks
+        # Key the cache on the source file's path, size and modification time so a changed parquet file is reprocessed
+        name = os.path.splitext(os.path.basename(parquet_file))[0]
+        source = os.stat(parquet_file)
+        source_key = f'{os.path.abspath(parquet_file)}:{source.st_size}:{source.st_mtime_ns}'
+        source_hash = hashlib.sha1(source_key.encode()).hexdigest()[:12]
+        self.cache_base = os.path.join(cache_dir, f'{name}_{sequence_length}' + ('_test' if is_test else ''))
+        self.cache_prefix = f'{self.cache_base}_v{self.cache_version}_{source_hash}'
+
+        # Preprocess the parquet file once, later runs memory map the cached arrays instead
+        if not os.path.exists(self.cache_path('data_all')):
+            self.remove_stale_caches()
+            self.preprocess_data(pd.read_parquet(parquet_file))
+            self.save_cache()
+        self.load_cache()
+
+    def cache_path(self, key):
+        return f'{self.cache_prefix}_{key}.npy'
+
+    def cache_keys(self):
+        # 'data_all' is written last so its presence marks a complete cache
+        return ['series_ids', 'step_all', 'timestamp_all', 'series_id_all'] + ([] if self.is_test else ['label_all']) + ['data_all']
+
+    def remove_stale_caches(self):
+        # Drop caches built from older versions of the same file or an older cache layout
+        for path in glob.glob(glob.escape(self.cache_base) + '_v[0-9]*_' + '?' * 12 + '_*'):
+            if not path.startswith(self.cache_prefix + '_'):
+                os.remove(path)
+
+    def save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_prefix) or '.', exist_ok=True)
+        for key in self.cache_keys():
+            # Write to a temporary file and rename it into place, so an interrupted save never leaves a truncated array
+            path = self.cache_path(key)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, getattr(self, key))
+            os.replace(path + '.tmp', path)
+
+    def load_cache(self):
+        # Copy-on-write maps keep the arrays writable for torch.from_numpy while sharing pages across workers
+        for key in self.cache_keys():
+            setattr(self, key, np.load(self.cache_path(key), mmap_mode='c'))
+        if self.is_test:
+            self.label_all = None
+
+    def __getstate__(self):
+        # Spawned DataLoader workers receive a pickled copy of the dataset and a pickled memmap is a full in-memory array,
+        # so leave the arrays out and reopen the maps in the worker instead
+        state = self.__dict__.copy()
+        for key in self.cache_keys():
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load_cache()
+
+    def preprocess_data(self, data):
+        series_ids = data['series_id'].unique()
+        # Chunks refer to their series by index into this array, which maps back to the original ids
+        self.series_ids = np.asarray(series_ids, dtype=str)
+
+        # Extract the columns once and slice them per series instead of masking the whole frame for every series
+        features = data[['anglez', 'enmo']].to_numpy(dtype=np.float32)
+        timestamps = pd.to_datetime(data['timestamp'], utc=True)
+        if timestamps.isna().any():
+            raise ValueError('Found missing timestamps in the dataset')
+        # Seconds since the epoch, independent of the datetime64 unit pandas chose for the column
+        timestamps = ((timestamps - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(seconds=1)).to_numpy()
+        steps = data['step'].to_numpy(dtype=np.float32)
+        if not self.is_test:
+            labels = data['label'].to_numpy(dtype=np.int64)
+        series_rows = data.groupby('series_id', sort=False).indices
+
+        # Store all chunks in a few contiguous arrays, dropping the incomplete chunk at the end of each series
+        total_chunks = sum(len(series_rows[series_id]) // self.sequence_length for series_id in series_ids)
+        self.data_all = np.empty((total_chunks, self.sequence_length, 2), dtype=np.float32)
+        self.step_all = np.empty((total_chunks, self.sequence_length), dtype=np.float32)
+        self.timestamp_all = np.empty((total_chunks, self.sequence_length), dtype=np.float64)
+        self.label_all = None if self.is_test else np.empty((total_chunks, self.sequence_length), dtype=np.int64)
+        self.series_id_all = np.empty(total_chunks, dtype=np.int64)
+
+        offset = 0
+        for series_index, series_id in enumerate(series_ids):
+            rows = series_rows[series_id]
+            num_chunks = len(rows) // self.sequence_length
+            if num_chunks == 0:
+                continue
+            rows = rows[:num_chunks * self.sequence_length]
+            chunks = slice(offset, offset + num_chunks)
+
+            self.data_all[chunks] = features[rows].reshape(num_chunks, self.sequence_length, 2)
+            self.step_all[chunks] = steps[rows].reshape(num_chunks, self.sequence_length)
+            self.timestamp_all[chunks] = timestamps[rows].reshape(num_chunks, self.sequence_length)
+            if not self.is_test:
+                self.label_all[chunks] = labels[rows].reshape(num_chunks, self.sequence_length)
+            self.series_id_all[chunks] = series_index
+            offset += num_chunks
 
     def __len__(self):
-        return len(self.data_chunks)
+        return len(self.data_all)
 
     def __getitem__(self, idx):
-        return self.data_chunks[idx]
+        # Training and validation only use the inputs and labels, so skip collating the other fields
+        if self.train_mode:
+            return {'data': torch.from_numpy(self.data_all[idx]), 'label': torch.from_numpy(self.label_all[idx])}
+
+        item = {
+            'series_id': int(self.series_id_all[idx]),
+            'step': torch.from_numpy(self.step_all[idx]),
+            'timestamp': torch.from_numpy(self.timestamp_all[idx]),
+            'data': torch.from_numpy(self.data_all[idx])
+        }
+        if not self.is_test:
+            item['label'] = torch.from_numpy(self.label_all[idx])
+        return item
+
+
+class PrefetchLoader:
+    # Copies the next batch to the GPU on a side stream while the current batch is being processed
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream() if device == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        return {key: value.to(self.device, non_blocking=True) if torch.is_tensor(value) else value for key, value in batch.items()}
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield self.to_device(batch)
+            return
+
+        batch = None
+        for next_batch in self.loader:
+            with torch.cuda.stream(self.stream):
+                next_batch = self.to_device(next_batch)
+            if batch is not None:
+                yield batch
+
+            # Make the compute stream wait for the copy and keep the copied tensors alive until it is done with them
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for value in next_batch.values():
+                if torch.is_tensor(value):
+                    value.record_stream(torch.cuda.current_stream())
+            batch = next_batch
+
+        if batch is not None:
+            yield batch
+
+
+class BinaryCRF(nn.Module):
+    # Linear-chain CRF over batch-first emissions, specialised to the two sleep states
+    num_tags = 2
+
+    def __init__(self):
+        super(BinaryCRF, self).__init__()
+        self.start_transitions = nn.Parameter(torch.empty(self.num_tags))
+        self.transitions = nn.Parameter(torch.empty(self.num_tags, self.num_tags))
+        self.end_transitions = nn.Parameter(torch.empty(self.num_tags))
+        nn.init.uniform_(self.start_transitions, -0.1, 0.1)
+        nn.init.uniform_(self.transitions, -0.1, 0.1)
+        nn.init.uniform_(self.end_transitions, -0.1, 0.1)
+
+    def forward(self, emissions, tags):
+        # Log likelihood of the tag sequences, summed over the batch
+        return (self.score_sentence(emissions, tags) - self.forward_alg(emissions)).sum()
+
+    def forward_alg(self, emissions):
+        # Log partition function, one log-sum-exp over the previous tag per timestep
+        alpha = self.start_transitions + emissions[:, 0]
+        for t in range(1, emissions.size(1)):
+            alpha = torch.logsumexp(alpha.unsqueeze(2) + self.transitions + emissions[:, t].unsqueeze(1), dim=1)
+        return torch.logsumexp(alpha + self.end_transitions, dim=1)
+
+    def score_sentence(self, emissions, tags):
+        score = self.start_transitions[tags[:, 0]] + self.end_transitions[tags[:, -1]]
+        score = score + emissions.gather(2, tags.unsqueeze(2)).squeeze(2).sum(dim=1)
+        score = score + self.transitions[tags[:, :-1], tags[:, 1:]].sum(dim=1)
+        return score
 
 
 class ActiNetCRFModel(nn.Module):
     def __init__(self, input_size = 2, hidden_size = 64, num_classes = 2, dropout = 0.25):
         super(ActiNetCRFModel, self).__init__()
-        self.name = 'ActiNetCRFv1'
+        assert num_classes == BinaryCRF.num_tags, 'The CRF only models the two sleep states'
+        self.name = 'ActiNetCRFv2'
         self.num_classes = num_classes
+        # Pointwise blocks applied per timestep on (B, L, C), equivalent to kernel size 1 convolutions without the transposes
         self.model = nn.Sequential(
-            nn.Conv1d(in_channels=input_size, out_channels=hidden_size, kernel_size=1, padding = 'same'),
+            nn.Linear(input_size, hidden_size),
             nn.GELU(),
             nn.Dropout(dropout),
-            nn.BatchNorm1d(hidden_size),
-            nn.Conv1d(in_channels=hidden_size, out_channels=hidden_size, kernel_size=1, padding = 'same'),
+            nn.LayerNorm(hidden_size),
+            nn.Linear(hidden_size, hidden_size),
             nn.GELU(),
             nn.Dropout(dropout),
-            nn.BatchNorm1d(hidden_size),
-            nn.Conv1d(in_channels=hidden_size, out_channels=hidden_size, kernel_size=1, padding = 'same'),
+            nn.LayerNorm(hidden_size),
+            nn.Linear(hidden_size, hidden_size),
             nn.GELU(),
             nn.Dropout(dropout),
-            nn.BatchNorm1d(hidden_size),
-            nn.Conv1d(in_channels=hidden_size, out_channels=hidden_size, kernel_size=1, padding = 'same'),
+            nn.LayerNorm(hidden_size),
+            nn.Linear(hidden_size, hidden_size),
             nn.GELU(),
             nn.Dropout(dropout),
-            nn.BatchNorm1d(hidden_size)
+            nn.LayerNorm(hidden_size)
         )
-        self.lstm = nn.LSTM(input_size=hidden_size, hidden_size=hidden_size,batch_first=True, bidirectional = True)
+        self.gru = nn.GRU(input_size=hidden_size, hidden_size=hidden_size, batch_first=True, bidirectional = True)
         self.fc = nn.Linear(2 * hidden_size, num_classes)
-        self.crf = CRF(num_classes)
+        self.crf = BinaryCRF()
 
     def forward(self, x, tags = None):
-        x = x.transpose(1, 2)
         x = self.model(x)
-        x = x.transpose(1, 2).contiguous()
-        x, _ = self.lstm(x)
+        x, _ = self.gru(x)
         logits = self.fc(x)
-        if tags is not None:
-            output = -self.crf(logits, tags)
-        else :
-            output = self.crf.decode(logits)
+
+        # Keep the CRF log-sum-exp and Viterbi scores in fp32 when running under autocast
+        with torch.autocast(device_type=logits.device.type, enabled=False):
+            logits = logits.float()
+            if tags is not None:
+                output = -self.crf(logits, tags)
+            else :
+                output = self.decode_viterbi(logits)
         return output
 
+    def decode_viterbi(self, emissions):
+        # Batched Viterbi over (B, L, C) emissions, returns the best tag sequences as a (B, L) tensor
+        seq_length = emissions.size(1)
+        score = self.crf.start_transitions + emissions[:, 0]
+        history = []
+        for t in range(1, seq_length):
+            broadcast = score.unsqueeze(2) + self.crf.transitions + emissions[:, t].unsqueeze(1)
+            score, indices = broadcast.max(dim=1)
+            history.append(indices)
+        score = score + self.crf.end_transitions
+
+        best_tags = torch.empty(emissions.shape[:2], dtype=torch.long, device=emissions.device)
+        best_tags[:, -1] = score.argmax(dim=1)
+        for t in range(seq_length - 2, -1, -1):
+            best_tags[:, t] = history[t].gather(1, best_tags[:, t + 1].unsqueeze(1)).squeeze(1)
+        return best_tags
+
 
 def train_model(model, data_loader, criterion, optimizer):
     model.train()
-    total_loss = 0
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # Accumulate on the device so the loop does not sync with the GPU every batch
+    total_loss = torch.zeros((), device=device)
 
     # Wrap the DataLoader with tqdm to display a progress bar
     for batch in tqdm(data_loader, leave=False):
         # Extract data from the batch
-        input_data = batch['data'].to(device)
-        labels = batch['label'].type(torch.LongTensor).to(device)
+        input_data = batch['data'].to(device, non_blocking=True)
+        labels = batch['label'].to(device, non_blocking=True)
 
         # Clear the previous gradients
         optimizer.zero_grad()
 
-        # Forward pass
-        loss = model(input_data, tags = labels)
+        # Forward pass in bfloat16 mixed precision on GPUs that support it, which needs no gradient scaling. CPU training
+        # and older GPUs stay in fp32
+        use_bf16 = device == 'cuda' and torch.cuda.is_bf16_supported()
+        with torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=use_bf16):
+            loss = model(input_data, tags = labels)
 
         # Backward pass and optimization
         loss.backward()
         optimizer.step()
 
-        total_loss += loss.item()
+        total_loss += loss.detach()
 
     # Calculate accuracy and print during training
-    average_loss = total_loss / len(data_loader)
+    average_loss = (total_loss / len(data_loader)).item()
     return average_loss
 
 
 def test_model(model, test_loader, criterion):
     model.eval()
-    correct_predictions = 0
-    total_samples = 0
     all_preds = []
     all_labels = []
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
     with torch.no_grad():
         for batch in tqdm(test_loader, leave=False):
-            input_data = batch['data'].to(device)
-            labels = batch['label'].type(torch.LongTensor).to(device)
+            input_data = batch['data'].to(device, non_blocking=True)
+            labels = batch['label'].to(device, non_blocking=True)
 
-            logits = model(input_data)
-            logits = torch.tensor(np.array(logits).T).contiguous().to(device)
+            # Keep predictions on the device and copy them back once per epoch
+            all_preds.append(model(input_data).view(-1))
+            all_labels.append(labels.view(-1))
 
-            predicted = logits.view(-1)
-            labels_flat = labels.view(-1)
+    all_preds = torch.cat(all_preds)
+    all_labels = torch.cat(all_labels)
 
-            correct_predictions += torch.sum(predicted == labels_flat).item()
-            total_samples += labels.numel()
-
-            all_preds.extend(predicted.view(-1).cpu().numpy())
-            all_labels.extend(labels_flat.cpu().numpy())
-    
     # Calculate validation metrics
-    accuracy = correct_predictions / total_samples
+    accuracy = torch.sum(all_preds == all_labels).item() / all_labels.numel()
 
+    all_preds = all_preds.cpu().numpy()
+    all_labels = all_labels.cpu().numpy()
     precision = precision_score(all_labels, all_preds, average='weighted')
     recall = recall_score(all_labels, all_preds, average='weighted')
     f1 = f1_score(all_labels, all_preds, average='weighted')
@@ -281,24 +457,28 @@ def get_local_best(pred_dict, window_size=360):
 def predict(model, test_loader):
     model.eval()
 
-    # Make predictions on the test dataset
-    predictions = []
-    series_ids = []
-    steps = []
+    # Make predictions on the test dataset, filling arrays sized from the dataset length
+    num_samples = len(test_loader.dataset) * test_loader.dataset.sequence_length
+    predictions = np.empty(num_samples, dtype=np.int64)
+    series_ids = np.empty(num_samples, dtype=np.int64)
+    steps = np.empty(num_samples, dtype=np.float32)
+    offset = 0
     with torch.no_grad():
         for batch in tqdm(test_loader):
 
-           input_data = batch['data'].to(device)
-            # Forward pass
-            logits = model(input_data)
+            input_data = batch['data'].to(device)
+            # Forward pass, the CRF decodes straight to predicted labels
+            predicted = model(input_data)
 
-            # Convert logits to predictions
-            _, predicted = torch.max(logits, 2)
-            predictions.extend(predicted.cpu().numpy()[0])
-            series_ids.extend(np.full(len(predicted.cpu().numpy()[0]), batch['series_id'][0]))
-            steps.extend(batch['step'].cpu().numpy()[0])
+            num_steps = predicted.numel()
+            predictions[offset:offset + num_steps] = predicted.cpu().numpy().reshape(-1)
+            series_ids[offset:offset + num_steps] = np.repeat(batch['series_id'].numpy(), predicted.shape[1])
+            steps[offset:offset + num_steps] = batch['step'].numpy().reshape(-1)
+            offset += num_steps
 
-    return pred_to_dict(series_ids, steps, predictions)
+    # Map the integer series ids back to the original ids once per series
+    pred_dict = pred_to_dict(series_ids[:offset], steps[:offset], predictions[:offset])
+    return {test_loader.dataset.series_ids[series_id]: series_dict for series_id, series_dict in pred_dict.items()}
 
 def get_events(pred_dict):
     round_func = np.vectorize(lambda i: 1 if i > 0.5 else 0)
@@ -306,31 +486,37 @@ def get_events(pred_dict):
     for series_id, series_dict in tqdm(pred_dict.items()):
       pred_dict[series_id]['preds'] = round_func(savgol_filter(pred_dict[series_id]['preds'], window_length=3000, polyorder=2))
 
-    prediction_rows = []
-    curr_state = None
+    # Find every state change in one pass per series instead of walking the sequence step by step
+    event_series, event_steps, event_kinds = [], [], []
     for series_id, series_dict in tqdm(pred_dict.items()):
-        curr_state = series_dict["preds"][0]
-        for pred, step in zip(series_dict["preds"][1:],  series_dict["steps"][1:]):
-
-            if pred != curr_state:
-                curr_state = pred
-                event = 'wakeup' if curr_state == 1 else 'onset'
-                prediction_rows.append({
-                    'row_id': len(prediction_rows),
-                    'series_id': series_id,
-                    'step': int(step),
-                    'event': event,
-                    'score': 1.0
-                })
-    return pd.DataFrame(prediction_rows)
+        preds = np.asarray(series_dict["preds"])
+        series_steps = np.asarray(series_dict["steps"])
+        changes = np.flatnonzero(np.diff(preds) != 0) + 1
+
+        event_series.append(np.full(len(changes), series_id, dtype=object))
+        event_steps.append(series_steps[changes].astype(int))
+        event_kinds.append(np.where(preds[changes] == 1, 'wakeup', 'onset'))
+
+    event_steps = np.concatenate(event_steps)
+    return pd.DataFrame({
+        'row_id': np.arange(len(event_steps)),
+        'series_id': np.concatenate(event_series),
+        'step': event_steps,
+        'event': np.concatenate(event_kinds),
+        'score': 1.0
+    })
 
 # Example usage for training DataLoader
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
+torch.backends.cudnn.benchmark = True  # Input shapes are fixed, so autotune the kernels once
 batch_size = 8  # Adjust based on your needs
+# Roughly one worker per physical core. Workers index into the memory mapped dataset arrays, shared with the parent
+# when forked and reopened from the cache files when spawned, so adding more does not duplicate the dataset in memory
+num_workers = max(1, (os.cpu_count() or 2) // 2)
 sequence_length = 250  # Adjust based on your needs
 
 print('Loading Dataset')
-dataset = SleepDataset(parquet_file='dataset/combined_0.parquet', sequence_length=sequence_length, is_test=False)
+dataset = SleepDataset(parquet_file='dataset/combined_0.parquet', sequence_length=sequence_length, is_test=False, train_mode=True)
 print('Dataset Loaded')
 
 # Split the dataset into training and validation sets (80:20)
@@ -342,16 +528,27 @@ train_loader = DataLoader(
     dataset=train_dataset,
     batch_size=batch_size,
     shuffle=True,
-    num_workers=2,  # Adjust based on your system capabilities
+    drop_last=True,  # Keep every training batch the same shape for the compiled model
+    num_workers=num_workers,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=4,
 )
 
 val_loader = DataLoader(
     dataset=val_dataset,
     batch_size=batch_size,
     shuffle=True,
-    num_workers=2,  # Adjust based on your system capabilities
+    num_workers=num_workers,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=4,
 )
 
+# Overlap the host to device copy of the next batch with compute on the current one
+train_loader = PrefetchLoader(train_loader, device)
+val_loader = PrefetchLoader(val_loader, device)
+
 # Example usage
 input_size = 2  # Assuming 2 features in the input (anglez and enmo)
 hidden_size = 64
@@ -362,9 +559,27 @@ num_epochs = 10
 
 # Initialize the model
 model = ActiNetCRFModel(input_size, hidden_size, num_classes, dropout).to(device)
+
+# The CRF scores are nn.Parameters and must follow the model to the device, otherwise decoding silently runs on the CPU
+for name, param in model.crf.named_parameters():
+    print(f'crf.{name}: {param.device}')
+assert model.crf.transitions.device == next(model.parameters()).device
 criterion = nn.CrossEntropyLoss()
 optimizer = optim.Adam(model.parameters(), lr=learning_rate)
 
+# Let Inductor fuse the Linear-GELU-Dropout-LayerNorm blocks into a few kernels for validation and prediction, which
+# see varying batch shapes (the partial last val batch, (1, 300) test batches). Compile them dynamically and without
+# CUDA graphs so new shapes neither trigger max-autotune recompiles nor graph re-recording. Module.compile works in
+# place, so the state_dict keys are unchanged. The training step below traces through these blocks anyway
+if device == 'cuda':
+    model.model.compile(mode='max-autotune-no-cudagraphs', dynamic=True)
+
+# Shapes are static during training, so compile the model and replay the compiled regions with CUDA graphs. Dynamo does
+# not trace nn.GRU by default, so the graph breaks there: the pointwise blocks and the fc + CRF loss are graphed while
+# the cuDNN GRU forward and backward run uncaptured in between. Validation, saving and prediction use the uncompiled
+# outer model, which shares the same parameters and only runs the compiled blocks above
+train_step_model = torch.compile(model, mode='reduce-overhead') if device == 'cuda' else model
+
 # +
 timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -375,7 +590,7 @@ log = open('logs/' + model.name + f'{timestamp}' + '.log', 'w')
 print('Starting Model Training')
 best_f1 = 0.0
 for epoch in range(num_epochs):
-    loss = train_model(model, train_loader, criterion, optimizer)
+    loss = train_model(train_step_model, train_loader, criterion, optimizer)
     print(f'Epoch [{epoch+1}/{num_epochs}], Loss: {loss:.4f}')
     log.write(f'Epoch [{epoch+1}/{num_epochs}], Loss: {loss:.4f}\n')
     accuracy, precision, recall, f1 = test_model(model, val_loader, criterion)
@@ -9,47 +9,71 @@ import random
 def predict_events(model, test_loader):
     model.eval()
 
-    # Make predictions on the test dataset
-    predictions = []
-    series_ids = []
-    steps = []  
+    # Make predictions on the test dataset, filling arrays sized from the dataset length and the sequence length of the
+    # first batch. Series ids are stored as indices into series_names, built from the collated batches
+    predictions = series_ids = steps = None
+    series_index = {}
+    series_names = []
+    offset = 0
     with torch.no_grad():
         for batch in tqdm(test_loader):
             test_input = batch['data']
-            print(test_input)
+            if predictions is None:
+                num_samples = len(test_loader.dataset) * test_input.shape[1]
+                predictions = np.empty(num_samples, dtype=np.int64)
+                series_ids = np.empty(num_samples, dtype=np.int64)
+                steps = np.empty(num_samples, dtype=np.float32)
 
             # Forward pass
             logits = model(test_input)
 
-            # Convert logits to predictions
-            _, predicted = torch.max(logits, 2)
-            predictions.extend(predicted.cpu().numpy()[0])
-            series_ids.extend(np.full(len(predicted.cpu().numpy()[0]), batch['series_id'][0]))
-            steps.extend(batch['step'].cpu().numpy()[0])
-            
-    pred_dict = pred_to_dict(series_ids, steps, predictions)
+            # Convert logits to predictions. ActiNetCRFModel returns decoded (B, L) labels as a tensor, while the torchcrf
+            # models (bilstmcrf.py, sleepformer.py) return a list of per-timestep lists that is transposed like in their test_model
+            if isinstance(logits, list):
+                predicted = torch.as_tensor(logits).T
+            elif logits.dim() == 3:
+                _, predicted = torch.max(logits, 2)
+            else:
+                predicted = logits
+            num_steps = predicted.numel()
+            predictions[offset:offset + num_steps] = predicted.cpu().numpy().reshape(-1)
+            # Datasets collate series ids either to a tensor of integer ids or to a list of id strings
+            batch_ids = batch['series_id'].tolist() if torch.is_tensor(batch['series_id']) else batch['series_id']
+            batch_series = np.empty(len(batch_ids), dtype=np.int64)
+            for i, series_id in enumerate(batch_ids):
+                if series_id not in series_index:
+                    series_index[series_id] = len(series_names)
+                    series_names.append(series_id)
+                batch_series[i] = series_index[series_id]
+            series_ids[offset:offset + num_steps] = np.repeat(batch_series, predicted.shape[1])
+            steps[offset:offset + num_steps] = batch['step'].cpu().numpy().reshape(-1)
+            offset += num_steps
+
+    pred_dict = pred_to_dict(series_ids[:offset], steps[:offset], predictions[:offset])
     pred_dict = remove_outliers(pred_dict)
     pred_dict = get_local_best(pred_dict)
 
-    prediction_rows = []
-    curr_state = None
-    curr_series = None
+    # Find every state change in one pass per series instead of walking the sequence step by step
+    event_series, event_steps, event_kinds = [], [], []
     for series_id, series_dict in tqdm(pred_dict.items()):
-        curr_state = series_dict["preds"][0]
-        for pred, step in zip(series_dict["preds"][1:],  series_dict["steps"][1:]):
-            
-            if pred != curr_state:
-                curr_state = pred
-                event = 'wakeup' if curr_state == 1 else 'onset'
-                prediction_rows.append({
-                    'row_id': len(prediction_rows),
-                    'series_id': curr_series,
-                    'step': int(step),
-                    'event': event,
-                    'score': 1.0
-                })
-    
-    return pd.DataFrame(prediction_rows)
+        preds = np.asarray(series_dict["preds"])
+        series_steps = np.asarray(series_dict["steps"])
+        length = min(len(preds), len(series_steps))
+        changes = np.flatnonzero(np.diff(preds[:length]) != 0) + 1
+
+        event_series.append(np.full(len(changes), series_id, dtype=np.int64))
+        event_steps.append(series_steps[changes].astype(int))
+        event_kinds.append(np.where(preds[changes] == 1, 'wakeup', 'onset'))
+
+    # Series ids are integer indices into series_names until here
+    event_steps = np.concatenate(event_steps)
+    return pd.DataFrame({
+        'row_id': np.arange(len(event_steps)),
+        'series_id': np.array(series_names, dtype=object)[np.concatenate(event_series)],
+        'step': event_steps,
+        'event': np.concatenate(event_kinds),
+        'score': 1.0
+    })
 
 
 # +